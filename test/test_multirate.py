@@ -26,10 +26,13 @@ THE SOFTWARE.
 # avoid spurious: pytest.mark.parametrize is not callable
 # pylint: disable=not-callable
 
+import os
+from functools import lru_cache
+from itertools import islice
+
 import numpy as np
 import numpy.linalg as la
 import pytest
-from pytools import memoize_method
 from leap.multistep.multirate import (
         rhs_policy,
         MultiRateHistory as MRHistory,
@@ -43,9 +46,39 @@ from utils import (  # noqa
         python_method_impl_codegen as pmi_cg)
 
 
+# Code generation depends neither on the ODE system nor on the time step,
+# so share it across checkers (and hence across the "system" parametrization).
+@lru_cache(maxsize=None)
+def _generate_mrab_code(method_name, order, hist_length, step_ratio, static_dt):
+    method = TwoRateAdamsBashforthMethodBuilder(
+            method_name, order, step_ratio,
+            static_dt=static_dt,
+            hist_consistency_threshold=1e-8,
+            early_hist_consistency_threshold=f"<dt>**{order}",
+            hist_length_slow=hist_length,
+            hist_length_fast=hist_length)
+
+    # Early consistency threshold checked for convergence
+    # with timestep change - C. Mikida, 2/6/18 (commit hash 2e6ca077)
+
+    # With method 4-Ss (limiting case), the following maximum relative
+    # errors were observed:
+    # for dt = 0.015625: 3.11E-09
+    # for dt = 0.0078125: 1.04e-10
+    # Corresponding EOC: 4.90
+
+    # Reported relative errors show that no constant factor is needed on
+    # early consistency threshold
+
+    return method.generate()
+
+
 class MultirateTimestepperAccuracyChecker:
     """Check that the multirate timestepper has the advertised accuracy."""
 
+    __slots__ = ["method", "order", "hist_length", "step_ratio", "static_dt",
+            "ode", "method_impl", "display_dag", "display_solution"]
+
     def __init__(self, method, order, hist_length, step_ratio, static_dt, ode,
             method_impl, display_dag=False, display_solution=False):
         self.method = method
@@ -58,37 +91,19 @@ class MultirateTimestepperAccuracyChecker:
         self.display_dag = display_dag
         self.display_solution = display_solution
 
-    @memoize_method
-    def get_code(self, dt):
-        method = TwoRateAdamsBashforthMethodBuilder(
-                self.method, self.order, self.step_ratio,
-                static_dt=self.static_dt,
-                hist_consistency_threshold=1e-8,
-                early_hist_consistency_threshold=dt**self.order,
-                hist_length_slow=self.hist_length,
-                hist_length_fast=self.hist_length)
-
-        # Early consistency threshold checked for convergence
-        # with timestep change - C. Mikida, 2/6/18 (commit hash 2e6ca077)
-
-        # With method 4-Ss (limiting case), the following maximum relative
-        # errors were observed:
-        # for dt = 0.015625: 3.11E-09
-        # for dt = 0.0078125: 1.04e-10
-        # Corresponding EOC: 4.90
-
-        # Reported relative errors show that no constant factor is needed on
-        # early consistency threshold
-
-        return method.generate()
+    def get_code(self):
+        return _generate_mrab_code(self.method, self.order, self.hist_length,
+                self.step_ratio, self.static_dt)
 
     def initialize_method(self, dt):
         # Requires a coupled component.
         def make_coupled(f2f, f2s, s2f, s2s):
             def coupled(t, y):
-                args = (t, y[0] + y[1], y[2] + y[3])
-                return np.array((f2f(*args), f2s(*args), s2f(*args),
-                    s2s(*args)),)
+                f, s = y[0] + y[1], y[2] + y[3]
+                # Return a fresh array: RHS values are kept in the method's
+                # history, so a reused buffer would be overwritten.
+                return np.array((f2f(t, f, s), f2s(t, f, s), s2f(t, f, s),
+                    s2s(t, f, s)))
             return coupled
 
         function_map = {"<func>f2f": self.ode.f2f_rhs,
@@ -97,8 +112,9 @@ class MultirateTimestepperAccuracyChecker:
                 self.ode.f2f_rhs, self.ode.s2f_rhs, self.ode.f2s_rhs,
                 self.ode.s2s_rhs)}
 
-        print(self.get_code(dt))
-        method = self.method_impl(self.get_code(dt), function_map=function_map)
+        if os.environ.get("LEAP_DUMP_CODE"):
+            print(self.get_code())
+        method = self.method_impl(self.get_code(), function_map=function_map)
 
         t = self.ode.t_start
         y = self.ode.initial_values
@@ -111,27 +127,34 @@ class MultirateTimestepperAccuracyChecker:
 
         method = self.initialize_method(dt)
 
+        # Only the final state enters the error, so the full trajectory is
+        # only kept around if it is going to be plotted.
+        keep_history = self.display_solution
         times = []
         slow = []
         fast = []
+
+        # Steppers yield exact StateComputed instances (no subclasses), so a
+        # class identity check suffices.
+        state_computed = method.StateComputed
+        t = None
+        y_slow = y_fast = None
         for event in method.run(t_end=final_t):
-            if isinstance(event, method.StateComputed):
+            if event.__class__ is state_computed:
                 if event.component_id == "slow":
-                    slow.append(event.state_component)
-                    times.append(event.t)
+                    t = event.t
+                    y_slow = event.state_component
+                    if keep_history:
+                        times.append(t)
+                        slow.append(y_slow)
                 elif event.component_id == "fast":
-                    fast.append(event.state_component)
-
-        assert abs(times[-1] - final_t) < 1e-10
+                    y_fast = event.state_component
+                    if keep_history:
+                        fast.append(y_fast)
 
-        if 0:
-            import matplotlib.pyplot as pt
-            pt.plot(times, slow)
-            pt.plot(times, self.ode.soln_1(times))
-            pt.show()
+        assert abs(t - final_t) < 1e-10
 
-        t = times[-1]
-        y = (fast[-1], slow[-1])
+        y = (y_fast, y_slow)
 
         from multirate_test_systems import Basic, Tria
 
@@ -141,16 +164,16 @@ class MultirateTimestepperAccuracyChecker:
                 self.plot_solution(times, fast, self.ode.soln_0)
             return abs(y[0]-self.ode.soln_0(t))
         else:
-            from math import sqrt
+            from math import hypot
             if self.display_solution:
                 self.plot_solution(times, fast, self.ode.soln_0)
                 self.plot_solution(times, slow, self.ode.soln_1)
-            return abs(sqrt(y[0]**2 + y[1]**2)
-                    - sqrt(self.ode.soln_0(t)**2 + self.ode.soln_1(t)**2))
+            return abs(hypot(y[0], y[1])
+                    - hypot(self.ode.soln_0(t), self.ode.soln_1(t)))
 
-    def show_dag(self, dt=2**(-6)):
+    def show_dag(self):
         from dagrt.language import show_dependency_graph
-        show_dependency_graph(self.get_code(dt))
+        show_dependency_graph(self.get_code())
 
     def plot_solution(self, times, values, soln, label=None):
         import matplotlib.pyplot as pt
@@ -211,8 +234,35 @@ def test_multirate_accuracy(method_name, order, hist_length,
         method_impl=pmi_cg)()
 
 
-def test_single_rate_identical(order=3, hist_length=3):
+@lru_cache(maxsize=None)
+def _generate_single_rate_ab_code(order, hist_length):
     from leap.multistep import AdamsBashforthMethodBuilder
+    method = AdamsBashforthMethodBuilder("y", order=order,
+            hist_length=hist_length)
+    return method.generate()
+
+
+@lru_cache(maxsize=None)
+def _generate_single_rate_mrab_code(order, hist_length):
+    method = MultiRateMultiStepMethodBuilder(
+                order,
+                (
+                    (
+                        "dt", "fast", "=",
+                        MRHistory(1, "<func>f", ("fast", "slow",),
+                            hist_length=hist_length),
+                        ),
+                    (
+                        "dt", "slow", "=",
+                        MRHistory(1, "<func>s", ("fast", "slow",),
+                            rhs_policy=rhs_policy.late, hist_length=hist_length),
+                        ),),
+                hist_consistency_threshold=1e-8,
+                early_hist_consistency_threshold=f"<dt>**{order}")
+    return method.generate()
+
+
+def test_single_rate_identical(order=3, hist_length=3):
     from dagrt.exec_numpy import NumpyInterpreter
 
     from multirate_test_systems import Full
@@ -223,9 +273,7 @@ def test_single_rate_identical(order=3, hist_length=3):
 
     # {{{ single rate
 
-    single_rate_method = AdamsBashforthMethodBuilder("y", order=order,
-            hist_length=hist_length)
-    single_rate_code = single_rate_method.generate()
+    single_rate_code = _generate_single_rate_ab_code(order, hist_length)
 
     def single_rate_rhs(t, y):
         f, s = y
@@ -248,34 +296,17 @@ def test_single_rate_identical(order=3, hist_length=3):
 
     nsteps = 20
 
-    for event in single_rate_interp.run():
-        if isinstance(event, single_rate_interp.StateComputed):
-            single_rate_values[event.t] = event.state_component
-
-            if len(single_rate_values) == nsteps:
-                break
+    state_computed = single_rate_interp.StateComputed
+    state_events = (event for event in single_rate_interp.run()
+            if event.__class__ is state_computed)
+    for event in islice(state_events, nsteps):
+        single_rate_values[event.t] = event.state_component
 
     # }}}
 
     # {{{ two rate
 
-    multi_rate_method = MultiRateMultiStepMethodBuilder(
-                order,
-                (
-                    (
-                        "dt", "fast", "=",
-                        MRHistory(1, "<func>f", ("fast", "slow",),
-                            hist_length=hist_length),
-                        ),
-                    (
-                        "dt", "slow", "=",
-                        MRHistory(1, "<func>s", ("fast", "slow",),
-                            rhs_policy=rhs_policy.late, hist_length=hist_length),
-                        ),),
-                hist_consistency_threshold=1e-8,
-                early_hist_consistency_threshold=dt**order)
-
-    multi_rate_code = multi_rate_method.generate()
+    multi_rate_code = _generate_single_rate_mrab_code(order, hist_length)
 
     def rhs_fast(t, fast, slow):
         return ode.f2f_rhs(t, fast, slow)+ode.s2f_rhs(t, fast, slow)
@@ -293,28 +324,29 @@ def test_single_rate_identical(order=3, hist_length=3):
                 "slow": ode.soln_1(t_start),
                 })
 
-    multi_rate_values = {}
-
-    for event in multi_rate_interp.run():
-        if isinstance(event, single_rate_interp.StateComputed):
-            idx = {"fast": 0, "slow": 1}[event.component_id]
-            if event.t not in multi_rate_values:
-                multi_rate_values[event.t] = [None, None]
-
-            multi_rate_values[event.t][idx] = event.state_component
+    multi_rate_values = np.empty((nsteps, 2))
+    multi_rate_t_to_row = {}
+    component_to_col = {"fast": 0, "slow": 1}
 
-            if len(multi_rate_values) > nsteps:
-                break
+    # Each step yields one fast and one slow state.
+    state_computed = multi_rate_interp.StateComputed
+    state_events = (event for event in multi_rate_interp.run()
+            if event.__class__ is state_computed)
+    for event in islice(state_events, 2*nsteps):
+        row = multi_rate_t_to_row.setdefault(event.t, len(multi_rate_t_to_row))
+        multi_rate_values[row, component_to_col[event.component_id]] = \
+                event.state_component
 
     # }}}
 
     times = sorted(single_rate_values)
     single_rate_values = np.array([single_rate_values[t] for t in times])
-    multi_rate_values = np.array([multi_rate_values[t] for t in times])
+    multi_rate_values = multi_rate_values[
+            [multi_rate_t_to_row[t] for t in times]]
     print(single_rate_values)
     print(multi_rate_values)
 
-    diff = la.norm((single_rate_values-multi_rate_values).reshape(-1))
+    diff = la.norm(single_rate_values-multi_rate_values)
 
     assert diff < 1e-13
 
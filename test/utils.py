@@ -20,6 +20,8 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+from weakref import WeakKeyDictionary
+
 import numpy as np
 
 
@@ -30,10 +32,22 @@ def python_method_impl_interpreter(code, **kwargs):
     return NumpyInterpreter(code, **kwargs)
 
 
+# Compiling the generated class dominates the cost of setting up a method.
+# Callers typically instantiate the same code several times (e.g. once per
+# time step size in a convergence study), so keep one class per code object.
+_python_method_class_cache = WeakKeyDictionary()
+
+
 def python_method_impl_codegen(code, **kwargs):
-    from dagrt.codegen import PythonCodeGenerator
-    codegen = PythonCodeGenerator(class_name="Method")
-    return codegen.get_class(code)(**kwargs)
+    try:
+        method_class = _python_method_class_cache[code]
+    except KeyError:
+        from dagrt.codegen import PythonCodeGenerator
+        codegen = PythonCodeGenerator(class_name="Method")
+        method_class = _python_method_class_cache[code] = \
+                codegen.get_class(code)
+
+    return method_class(**kwargs)
 
 # }}}
 